@@ -1755,18 +1755,19 @@ class MM3(FF):
                     'Value of {} is too high! Skipping write.'.format(param))
             elif param.mm3_col == 1:
                 lines[param.mm3_row - 1] = (line[:P_1_START] +
-                                            '{:10.4f}'.format(param.value) +
+                                            '%10.4f' % param.value +
                                             line[P_1_END:])
             elif param.mm3_col == 2:
                 lines[param.mm3_row - 1] = (line[:P_2_START] +
-                                            '{:10.4f}'.format(param.value) +
+                                            '%10.4f' % param.value +
                                             line[P_2_END:])
             elif param.mm3_col == 3:
                 lines[param.mm3_row - 1] = (line[:P_3_START] +
-                                            '{:10.4f}'.format(param.value) +
+                                            '%10.4f' % param.value +
                                             line[P_3_END:])
+        # Write everything with a single call rather than line by line.
         with open(path, 'w') as f:
-            f.writelines(lines)
+            f.write(''.join(lines))
         logger.log(10, 'WROTE: {}'.format(path))
     def alternate_export_ff(self, path=None, params=None):
         """
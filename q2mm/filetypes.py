@@ -22,7 +22,9 @@ from __future__ import absolute_import
 from __future__ import division
 
 from argparse import RawTextHelpFormatter
+from contextlib import closing
 from string import digits
+import io
 import logging
 import mmap
 import numpy as np
@@ -2842,12 +2844,35 @@ class MacroModel(File):
     def __init__(self, path):
         super(MacroModel, self).__init__(path)
         self._structures = None
+        self._buffer = None
+    @classmethod
+    def from_buffer(cls, buffer, path):
+        """
+        Reads the .mmo from a bytes-like object, such as an `mmap.mmap` of
+        the file, rather than opening path. The buffer has to stay open until
+        `structures` has been accessed.
+        """
+        mmo = cls(path)
+        mmo._buffer = buffer
+        return mmo
+    def _read_buffer_lines(self):
+        readline = getattr(self._buffer, 'readline', None)
+        if readline is None:
+            readline = io.BytesIO(self._buffer).readline
+        else:
+            self._buffer.seek(0)
+        for line in iter(readline, b''):
+            yield line.decode()
     @property
     def structures(self):
         if self._structures is None:
             logger.log(10, 'READING: {}'.format(self.filename))
             self._structures = []
-            with open(self.path, 'r') as f:
+            if self._buffer is None:
+                mmo_file = open(self.path, 'r')
+            else:
+                mmo_file = closing(self._read_buffer_lines())
+            with mmo_file as f:
                 count_current = 0
                 count_input = 0
                 count_structure = 0
@@ -2,8 +2,8 @@
 '''
 Selects parameters from force fields.
 
-ASSUMES THERE IS NO OVERLAP BETWEEN THE PARAMETERS SELECTED BY THE PARAMETER
-FILE AND BY PTYPES!
+Parameters selected by both the parameter file and by ptypes are only included
+once.
 '''
 from __future__ import print_function
 from __future__ import absolute_import
@@ -12,8 +12,11 @@ from __future__ import division
 import argparse
 import logging
 import logging.config
-import numpy as np
+import math
+import mmap
+import os
 import sys
+from collections import defaultdict
 
 import constants as co
 import datatypes
@@ -21,8 +24,17 @@ import filetypes
 
 logger = logging.getLogger(__name__)
 
+# basestring is gone in python3, where str covers both cases.
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 ALL_PARM_TYPES = ('ae', 'af', 'be', 'bf', 'df', 'imp1', 'imp2',
                   'sb', 'q', 'vdwe', 'vdwr')
+# Increase this whenever changes to datatypes.MM3 make previously cached
+# force fields invalid. See load_ff.
+FF_CACHE_VERSION = 1
 
 def return_params_parser(add_help=True):
     '''
@@ -87,13 +99,68 @@ vdwr - van der Waals radius''')
         help='Prints a file formatted for parameter tethering.')
     return parser
 
+# Build the parser once rather than every time main is called.
+PARSER = return_params_parser()
+
+def load_ff(path):
+    '''
+    Imports a MM3* force field.
+
+    If the environment variable Q2MM_FF_CACHE is set to 1, the imported force
+    field is pickled to ~/.cache/q2mm, keyed by the path, modification time
+    and size of the force field file. Later calls with the same unchanged
+    file load the pickle rather than parsing the file again. The key also
+    includes FF_CACHE_VERSION, the Python version and the modification time
+    of datatypes, so that pickles written by older code aren't reused.
+    '''
+    if os.environ.get('Q2MM_FF_CACHE') != '1':
+        ff = datatypes.MM3(path)
+        ff.import_ff()
+        return ff
+    import hashlib
+    import pickle
+    stat = os.stat(path)
+    key = (FF_CACHE_VERSION,
+           sys.version_info[:2],
+           os.path.getmtime(datatypes.__file__),
+           os.path.abspath(path),
+           getattr(stat, 'st_mtime_ns', stat.st_mtime),
+           stat.st_size)
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'q2mm')
+    cache_path = os.path.join(
+        cache_dir,
+        'ff_{}.pkl'.format(hashlib.sha1(repr(key).encode()).hexdigest()))
+    if os.path.exists(cache_path):
+        logger.log(10, 'READING CACHED FF: %s', cache_path)
+        with open(cache_path, 'rb') as f:
+            ff = pickle.load(f)
+        # The cached copy may have been made from a different working
+        # directory, so use the path as given here.
+        ff.path = path
+        return ff
+    ff = datatypes.MM3(path)
+    ff.import_ff()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first so that other processes never see a
+    # partially written cache.
+    temp_path = '{}.{}'.format(cache_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump(ff, f, pickle.HIGHEST_PROTOCOL)
+    # os.replace overwrites an existing file on Windows too, but only exists
+    # in python3.
+    getattr(os, 'replace', os.rename)(temp_path, cache_path)
+    logger.log(10, 'WROTE CACHED FF: %s', cache_path)
+    return ff
+
 def trim_params_by_type(params, ptypes):
     '''
     Select all parameters with a matching ptype.
     '''
+    ptypes = frozenset(ptypes)
     chosen_params = [x for x in params if x.ptype in ptypes]
-    logger.log(20, '  -- Trimmed number of parameters down to {}.'.format(
-            len(chosen_params)))
+    logger.log(20, '  -- Trimmed number of parameters down to %d.',
+               len(chosen_params))
     return chosen_params
 
 def trim_params_by_file(params, filename):
@@ -106,19 +173,22 @@ def trim_params_by_file(params, filename):
     '''
     # This will hold the parameters you chose.
     chosen_params = []
-    # All parameters read from the file.
-    temp_params = read_param_file(filename)
+    # All parameters read from the file. The MM3* row and column are packed
+    # into a single integer key (row << 32 | col) so each parameter only needs
+    # one lookup.
+    temp_map = {}
+    for mm3_row, mm3_col, allowed_range in read_param_file(filename):
+        temp_map[(mm3_row << 32) | mm3_col] = allowed_range
     # Keep only the parameters that are specified in the file.
     for param in params:
-        for temp_param in temp_params:
-            if param.mm3_row == temp_param[0] and \
-                    param.mm3_col == temp_param[1]:
-                # Update the allow negative information.
-                param._allowed_range = temp_param[2]
-                param.value_in_range(param.value)
-                chosen_params.append(param)
-    logger.log(20, '  -- Trimmed number of parameters down to {}.'.format(
-            len(chosen_params)))
+        key = (param.mm3_row << 32) | param.mm3_col
+        if key in temp_map:
+            # Update the allow negative information.
+            param._allowed_range = temp_map[key]
+            param.value_in_range(param.value)
+            chosen_params.append(param)
+    logger.log(20, '  -- Trimmed number of parameters down to %d.',
+               len(chosen_params))
     return chosen_params
 
 def read_param_file(filename):
@@ -169,138 +239,233 @@ def read_param_file(filename):
     Doesn't actually return datatypes.Param objects.
     '''
     temp_params = []
+    # Read the whole file with a single call rather than line by line.
     with open(filename, 'r') as f:
-        for line in f:
-            line = line.partition('#')[0] # Ignore everything after a pound.
-            line = line.partition('!')[0] # ! counts as comments too.
-            cols = line.split()
-            if cols:
-                mm3_row, mm3_col = int(cols[0]), int(cols[1])
-                # Check if you allow negative values.
-                if 'neg' in cols[2:]:
-                    allowed_range = [-float('inf'), 0.]
-                elif 'pos' in cols[2:]:
-                    allowed_range = [0., float('inf')]
-                elif 'both' in cols[2:]:
-                    allowed_range = [-float('inf'), float('inf')]
-                elif cols[2:]:
-                    # Selects all values after 2 as a list, and then
-                    # trims to only 2 values.
-                    allowed_range = [float(x) for x in cols[2:][:2]]
-                else:
-                    allowed_range = None
-                # Add information to the temporary list.
-                temp_params.append((mm3_row, mm3_col, allowed_range))
+        lines = f.read().splitlines()
+    for line in lines:
+        line = line.partition('#')[0] # Ignore everything after a pound.
+        line = line.partition('!')[0] # ! counts as comments too.
+        cols = line.split()
+        if cols:
+            mm3_row, mm3_col = int(cols[0]), int(cols[1])
+            # Check if you allow negative values.
+            if 'neg' in cols[2:]:
+                allowed_range = [-float('inf'), 0.]
+            elif 'pos' in cols[2:]:
+                allowed_range = [0., float('inf')]
+            elif 'both' in cols[2:]:
+                allowed_range = [-float('inf'), float('inf')]
+            elif cols[2:]:
+                # Selects all values after 2 as a list, and then
+                # trims to only 2 values.
+                allowed_range = [float(x) for x in cols[2:][:2]]
+            else:
+                allowed_range = None
+            # Add information to the temporary list.
+            temp_params.append((mm3_row, mm3_col, allowed_range))
     return temp_params
 
-def gather_values(mmos):
+def gather_sums(mmos):
     '''
-    Gather bonds and angles from MacroModel .mmo files. Could expand to load
-    torsions.
+    Gather running statistics of bonds and angles from MacroModel .mmo files.
+    The individual values aren't stored, only the count, mean and sum of
+    squared deviations from the mean (M2) for each force field row. These are
+    updated with Welford's algorithm, which avoids the cancellation of using
+    the sum of squares.
 
     Ex.:
-      bond_dic = {1857: [2.2233, 2.2156, 2.5123],
-                  1858: [1.3601, 1.3535, 1.3532]
-                 }
+      bond_sums = {1857: [3, 2.3171, 0.0572],
+                   1858: [3, 1.3556, 0.0000]
+                  }
     '''
-
-    bond_dic = {}
-    angle_dic = {}
-    torsion_dic = {}
+    bond_sums = defaultdict(lambda: [0, 0., 0.])
+    angle_sums = defaultdict(lambda: [0, 0., 0.])
     for mmo in mmos:
         for structure in mmo.structures:
             for bond in structure.bonds:
-                if bond.ff_row in bond_dic:
-                    bond_dic[bond.ff_row].append(bond.value)
-                else:
-                    bond_dic[bond.ff_row] = [bond.value]
+                value = bond.value
+                sums = bond_sums[bond.ff_row]
+                sums[0] += 1
+                delta = value - sums[1]
+                sums[1] += delta / sums[0]
+                sums[2] += delta * (value - sums[1])
             for angle in structure.angles:
-                if angle.ff_row in angle_dic:
-                    angle_dic[angle.ff_row].append(angle.value)
-                else:
-                    angle_dic[angle.ff_row] = [angle.value]
-            for torsion in structure.torsions:
-                if torsion.ff_row in torsion_dic:
-                    torsion_dic[torsion.ff_row].append(torsion.value)
-                else:
-                    torsion_dic[torsion.ff_row] = [torsion.value]
-    return bond_dic, angle_dic, torsion_dic
+                value = angle.value
+                sums = angle_sums[angle.ff_row]
+                sums[0] += 1
+                delta = value - sums[1]
+                sums[1] += delta / sums[0]
+                sums[2] += delta * (value - sums[1])
+    return dict(bond_sums), dict(angle_sums)
+
+def reduce_mmo(filename):
+    '''
+    Reads a single MacroModel .mmo file and reduces it to the bond and angle
+    totals from gather_sums along with the set of torsion rows used. This is
+    far cheaper to send between processes than a filetypes.MacroModel object.
+    '''
+    # mmap can't map empty files.
+    if os.path.getsize(filename) == 0:
+        return {}, {}, set()
+    # Memory map the file rather than reading it through many small reads.
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        mmo = filetypes.MacroModel.from_buffer(buffer, filename)
+        bond_sums, angle_sums = gather_sums([mmo])
+        torsion_rows = set(torsion.ff_row
+                           for structure in mmo.structures
+                           for torsion in structure.torsions)
+    finally:
+        buffer.close()
+    return bond_sums, angle_sums, torsion_rows
+
+def merge_sums(total, sums):
+    '''
+    Combines the statistics from one call of gather_sums into another, in
+    place, using Chan's parallel update of the mean and M2.
+    '''
+    for ff_row, (count, mean, m2) in sums.items():
+        if ff_row in total:
+            total_sums = total[ff_row]
+            total_count = total_sums[0] + count
+            delta = mean - total_sums[1]
+            total_sums[1] += delta * count / total_count
+            total_sums[2] += m2 + delta * delta * total_sums[0] * count / \
+                total_count
+            total_sums[0] = total_count
+        else:
+            total[ff_row] = [count, mean, m2]
+
+def reduce_mmos(filenames):
+    '''
+    Uses reduce_mmo on every file, parsing them in parallel when there's more
+    than one, and merges the results in the order the files were given.
+    '''
+    if len(filenames) > 1:
+        # Only pay for importing multiprocessing when it's actually used.
+        import multiprocessing
+        # No point starting more processes than there are files.
+        pool = multiprocessing.Pool(
+            min(len(filenames), multiprocessing.cpu_count()))
+        try:
+            results = pool.map(reduce_mmo, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [reduce_mmo(filename) for filename in filenames]
+    bond_sums = {}
+    angle_sums = {}
+    torsion_rows = set()
+    for file_bond_sums, file_angle_sums, file_torsion_rows in results:
+        merge_sums(bond_sums, file_bond_sums)
+        merge_sums(angle_sums, file_angle_sums)
+        torsion_rows.update(file_torsion_rows)
+    return bond_sums, angle_sums, torsion_rows
+
+def average_sums(sums):
+    '''
+    Uses the statistics from gather_sums to get the average and standard
+    deviation of every force field row.
+
+    Returns two dictionaries keyed by force field row, the first containing
+    the mean and the second containing the standard deviation.
+
+    Ex.:
+      avg_dic = {1857: 2.3171,
+                 1858: 1.3556
+                }
+    '''
+    avg_dic = {}
+    std_dic = {}
+    for ff_row, (count, mean, m2) in sums.items():
+        avg_dic[ff_row] = mean
+        std_dic[ff_row] = math.sqrt(m2 / count)
+    return avg_dic, std_dic
 
 def main(args):
     '''
     Imports a force field object, which contains a list of all the available
     parameters. Returns a list of only the user selected parameters.
     '''
-    # basestring is deprecated in python3, str is probably safe to use in both
-    # but should be tested, for now sys.version_info switch can handle it
-    if sys.version_info > (3, 0):
-        if isinstance(args, str):
-            args = args.split()
-    else:
-        if isinstance(args, basestring):
-            args = args.split()
-    parser = return_params_parser()
-    opts = parser.parse_args(args)
+    if isinstance(args, string_types):
+        args = args.split()
+    opts = PARSER.parse_args(args)
     if opts.average or opts.check:
         assert opts.mmo, 'Must provide MacroModel .mmo files!'
     # The function import_ff should be more like something that just
     # interprets filetypes.
     # ff = datatypes.import_ff(opts.ffpath)
-    ff = datatypes.MM3(opts.ffpath)
-    ff.import_ff()
+    ff = load_ff(opts.ffpath)
     # Set the selected parameter types.
+    # The parser is shared between calls, so don't modify its default list
+    # in place.
     if opts.all:
-        opts.ptypes.extend(ALL_PARM_TYPES)
-    logger.log(20, 'Selected parameter types: {}'.format(' '.join(opts.ptypes)))
+        opts.ptypes = opts.ptypes + list(ALL_PARM_TYPES)
+    if logger.isEnabledFor(20):
+        logger.log(20, 'Selected parameter types: %s', ' '.join(opts.ptypes))
     params = []
     # These two functions populate the selected parameter list. Each takes
     # ff.params and returns a subset of it.
-    # WATCH OUT FOR DUPLICATES!
     if opts.ptypes:
         params.extend(trim_params_by_type(ff.params, opts.ptypes))
     if opts.pfile:
         params.extend(trim_params_by_file(ff.params, opts.pfile))
+    # Remove duplicates, which happen when a parameter is selected by both
+    # ptype and the parameter file, while keeping the original order.
+    if opts.ptypes and opts.pfile:
+        seen = set()
+        unique_params = []
+        for param in params:
+            if id(param) not in seen:
+                seen.add(id(param))
+                unique_params.append(param)
+        params = unique_params
     if opts.nozero:
         new_params = []
         for param in params:
             if not param.value == 0.:
                 new_params.append(param)
         params = new_params
-    logger.log(20, '  -- Total number of chosen parameters: {}'.format(
-            len(params)))
+    logger.log(20, '  -- Total number of chosen parameters: %d',
+               len(params))
     # Load MacroModel .mmo files if desired.
-    if opts.mmo or opts.average or opts.check:
-        mmos = []
-        for filename in opts.mmo:
-            mmos.append(filetypes.MacroModel(filename))
-            bond_dic, angle_dic, torsion_dic = gather_values(mmos)
+    if opts.average or opts.check:
+        bond_sums, angle_sums, torsion_rows = reduce_mmos(opts.mmo)
         # Check if the parameter's FF row shows up in the data gathered
         # from the MacroModel .mmo file. Currently only takes into
-        # account bonds and angles.
+        # account bonds, angles and torsions.
         if opts.check:
-            all_rows = bond_dic.keys() + angle_dic.keys() + torsion_dic.keys()
+            all_rows = set(bond_sums)
+            all_rows.update(angle_sums, torsion_rows)
             for param in params:
-                if not param.mm3_row in all_rows:
+                if param.mm3_row not in all_rows:
                     print("{} doesn't appear to be in use.".format(param))
         # Change parameter values to be their averages.
         if opts.average:
             # bond_avg = {1857: 2.3171,
             #             1858: 1.3556
             #            }
-            bond_avg = {}
-            for ff_row, values in bond_dic.items():
-                bond_avg[ff_row] = np.mean(values)
-                print(">> STD {}: {}".format(ff_row,np.std(values)))
-            angle_avg = {}
-            for ff_row, values in angle_dic.items():
-                angle_avg[ff_row] = np.mean(values)
-                print(">> STD {}: {}".format(ff_row,np.std(values)))
+            bond_avg, bond_std = average_sums(bond_sums)
+            for ff_row, std in bond_std.items():
+                print(">> STD {}: {}".format(ff_row, std))
+            angle_avg, angle_std = average_sums(angle_sums)
+            for ff_row, std in angle_std.items():
+                print(">> STD {}: {}".format(ff_row, std))
             # Update parameter values.
+            # Index the selected parameters by force field row so that only
+            # the rows seen in the .mmo files are visited.
+            row_index = defaultdict(list)
             for param in params:
-                if param.ptype in ['be', 'ae'] and param.mm3_row in bond_avg:
-                    param.value = bond_avg[param.mm3_row]
-                if param.ptype in ['be', 'ae'] and param.mm3_row in angle_avg:
-                    param.value = angle_avg[param.mm3_row]
+                row_index[param.mm3_row].append(param)
+            # Equilibrium bond lengths come from the bond averages and
+            # equilibrium angles from the angle averages.
+            for ptype, avg in (('be', bond_avg), ('ae', angle_avg)):
+                for ff_row, value in avg.items():
+                    for param in row_index.get(ff_row, ()):
+                        if param.ptype == ptype:
+                            param.value = value
             # Export the updated parameters.
             ff.export_ff(opts.average, params)
     # Print the parameters.
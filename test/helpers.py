@@ -0,0 +1,26 @@
+"""
+Shared helpers for writing small input files used by the tests.
+"""
+from __future__ import print_function
+
+BOND_LINE = ('   1   2   1.0000   1.0000   {:.4f}   0.0010'
+             '   HIGH   1   OPT {}\n')
+ANGLE_LINE = ('   1   2   3   1.0000   1.0000   1.0000   {:.4f}   0.0010'
+              '   0.0010   HIGH   1   OPT {}\n')
+
+def write_mmo(path, bonds, angles):
+    """
+    Writes a MacroModel .mmo with one structure per (bonds, angles) pair.
+    Each of those is a list of (value, ff_row).
+    """
+    lines = []
+    for i, (struct_bonds, struct_angles) in enumerate(zip(bonds, angles)):
+        lines.append(' Input Structure Name: s{}\n'.format(i))
+        lines.append(' BOND LENGTHS AND STRETCH ENERGIES\n')
+        lines.extend(BOND_LINE.format(*x) for x in struct_bonds)
+        lines.append(' ANGLES, BEND AND STRETCH BEND ENERGIES\n')
+        lines.extend(ANGLE_LINE.format(*x) for x in struct_angles)
+        lines.append(' BEND-BEND ANGLES AND ENERGIES\n')
+        lines.append(' Connection Table\n')
+    with open(path, 'w') as f:
+        f.writelines(lines)
@@ -0,0 +1,55 @@
+from __future__ import print_function
+import logging
+import logging.config
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+import constants as co
+import filetypes
+
+from .helpers import write_mmo
+
+logger = logging.getLogger(__name__)
+
+def summarize(structures):
+    return [([(x.atom_nums, x.value, x.ff_row) for x in struct.bonds],
+             [(x.atom_nums, x.value, x.ff_row) for x in struct.angles])
+            for struct in structures]
+
+class TestMacroModelFromBuffer(unittest.TestCase):
+    """
+    Check that reading a .mmo from a buffer gives the same structures as
+    reading it from its path.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.path = os.path.join(self.direc, 'test.mmo')
+        write_mmo(self.path,
+                  [[(1.51, 1859), (1.72, 1860)], [(1.53, 1859)]],
+                  [[(110.2, 1875)], [(111.4, 1875)]])
+        self.expected = summarize(filetypes.MacroModel(self.path).structures)
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+    def test_path(self):
+        self.assertEqual(len(self.expected), 2)
+        self.assertEqual(self.expected[1][0], [([1, 2], 1.53, 1859)])
+    def test_bytes(self):
+        with open(self.path, 'rb') as f:
+            mmo = filetypes.MacroModel.from_buffer(f.read(), self.path)
+        self.assertEqual(summarize(mmo.structures), self.expected)
+    def test_mmap(self):
+        with open(self.path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mmo = filetypes.MacroModel.from_buffer(buffer, self.path)
+            structures = summarize(mmo.structures)
+        finally:
+            buffer.close()
+        self.assertEqual(structures, self.expected)
+
+if __name__ == '__main__':
+    logging.config.dictConfig(co.LOG_SETTINGS)
+    unittest.main()
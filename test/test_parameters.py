@@ -0,0 +1,181 @@
+from __future__ import print_function
+import logging
+import logging.config
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+import constants as co
+import datatypes
+import filetypes
+import parameters
+
+from .helpers import write_mmo
+
+logger = logging.getLogger(__name__)
+
+FF_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'screen_sample',
+    'step-4_conformational-search', 'mm3.fld')
+
+class TestAverage(unittest.TestCase):
+    """
+    Check that --average gives equilibrium bonds the bond averages and
+    equilibrium angles the angle averages, even when a row shows up in both.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        mmo = os.path.join(self.direc, 'test.mmo')
+        # Row 1859 is a bond and row 1875 is an angle in FF_PATH. The extra
+        # angle on 1859 and bond on 1875 shouldn't be used for either.
+        write_mmo(mmo,
+                  [[(1.5, 1859), (3.0, 1875)], [(1.7, 1859), (3.0, 1875)]],
+                  [[(110., 1875), (100., 1859)], [(112., 1875), (100., 1859)]])
+        self.ff = parameters.main([
+                '-f', FF_PATH, '-pt', 'be', 'ae', '-m', mmo,
+                '-av', os.path.join(self.direc, 'mm3.fld')])
+        self.params = dict(((x.mm3_row, x.ptype), x) for x in self.ff.params)
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+    def test_bond_average(self):
+        self.assertAlmostEqual(self.params[(1859, 'be')].value, 1.6)
+    def test_angle_average(self):
+        self.assertAlmostEqual(self.params[(1875, 'ae')].value, 111.)
+
+class TestAverageManyFiles(unittest.TestCase):
+    """
+    Check that --average combines values spread across several .mmo files,
+    which are parsed in parallel, including an empty one.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.bonds = [1.5, 1.6, 1.7, 1.8]
+        self.angles = [110., 111., 112., 113.]
+        self.mmos = [os.path.join(self.direc, 'test{}.mmo'.format(i))
+                     for i in range(4)]
+        write_mmo(self.mmos[0],
+                  [[(1.5, 1859)], [(1.6, 1859)]],
+                  [[(110., 1875)], []])
+        write_mmo(self.mmos[1],
+                  [[(1.7, 1859)]],
+                  [[(111., 1875), (112., 1875)]])
+        write_mmo(self.mmos[2], [[(1.8, 1859)]], [[(113., 1875)]])
+        open(self.mmos[3], 'w').close()
+        self.ff = parameters.main(
+            ['-f', FF_PATH, '-pt', 'be', 'ae', '-m'] + self.mmos +
+            ['-av', os.path.join(self.direc, 'mm3.fld')])
+        self.params = dict(((x.mm3_row, x.ptype), x) for x in self.ff.params)
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+    def test_bond_average(self):
+        self.assertAlmostEqual(
+            self.params[(1859, 'be')].value, np.mean(self.bonds))
+    def test_angle_average(self):
+        self.assertAlmostEqual(
+            self.params[(1875, 'ae')].value, np.mean(self.angles))
+    def test_std(self):
+        bond_sums, angle_sums, _ = parameters.reduce_mmos(self.mmos)
+        bond_avg, bond_std = parameters.average_sums(bond_sums)
+        angle_avg, angle_std = parameters.average_sums(angle_sums)
+        self.assertAlmostEqual(bond_std[1859], np.std(self.bonds))
+        self.assertAlmostEqual(angle_std[1875], np.std(self.angles))
+
+class TestAverageSums(unittest.TestCase):
+    """
+    Check that the running statistics keep their precision for values with a
+    large mean and a tiny spread, both within one file and when partial
+    results from two files are merged.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.values = [1e4 + 1e-4 * k for k in range(10)]
+        self.mmos = []
+        for i, values in enumerate([self.values[:4], self.values[4:]]):
+            path = os.path.join(self.direc, 'test{}.mmo'.format(i))
+            write_mmo(path,
+                      [[(1.5, 1859)] for x in values],
+                      [[(x, 1875)] for x in values])
+            self.mmos.append(filetypes.MacroModel(path))
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+    def check(self, angle_sums):
+        avg, std = parameters.average_sums(angle_sums)
+        self.assertAlmostEqual(avg[1875], np.mean(self.values), places=8)
+        self.assertAlmostEqual(std[1875] / np.std(self.values), 1., places=8)
+    def test_gather(self):
+        bond_sums, angle_sums = parameters.gather_sums(self.mmos)
+        self.check(angle_sums)
+        # Identical values shouldn't leave any spread behind.
+        self.assertEqual(parameters.average_sums(bond_sums)[1][1859], 0.)
+    def test_merge(self):
+        angle_sums = {}
+        for mmo in self.mmos:
+            parameters.merge_sums(angle_sums, parameters.gather_sums([mmo])[1])
+        self.check(angle_sums)
+
+class TestLoadFFCache(unittest.TestCase):
+    """
+    Check that Q2MM_FF_CACHE=1 writes a pickle on the first load, reads it
+    back on the second and keeps the force field path as given.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        self.environ = dict((x, os.environ.get(x))
+                            for x in ('HOME', 'Q2MM_FF_CACHE'))
+        os.environ['HOME'] = self.direc
+        os.environ['Q2MM_FF_CACHE'] = '1'
+        self.cache_dir = os.path.join(self.direc, '.cache', 'q2mm')
+    def tearDown(self):
+        for key, value in self.environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.direc)
+    def test_cache(self):
+        ff = parameters.load_ff(FF_PATH)
+        cached = [x for x in os.listdir(self.cache_dir)
+                  if x.startswith('ff_') and x.endswith('.pkl')]
+        self.assertEqual(len(cached), 1)
+        # The second load has to come from the pickle.
+        import_ff = datatypes.MM3.import_ff
+        def fail(*args, **kwargs):
+            raise AssertionError('Force field was parsed again.')
+        datatypes.MM3.import_ff = fail
+        try:
+            cached_ff = parameters.load_ff(FF_PATH)
+        finally:
+            datatypes.MM3.import_ff = import_ff
+        self.assertEqual(
+            [(x.mm3_row, x.mm3_col, x.ptype, x.value) for x in ff.params],
+            [(x.mm3_row, x.mm3_col, x.ptype, x.value)
+             for x in cached_ff.params])
+        self.assertEqual(ff.path, FF_PATH)
+        self.assertEqual(cached_ff.path, FF_PATH)
+
+class TestOverlappingSelection(unittest.TestCase):
+    """
+    Check that parameters selected by both ptype and the parameter file are
+    only returned once.
+    """
+    def setUp(self):
+        self.direc = tempfile.mkdtemp()
+        pfile = os.path.join(self.direc, 'params.txt')
+        with open(pfile, 'w') as f:
+            # 1859 1 and 1860 1 are also selected by ptype be, 1861 2 isn't.
+            f.write('1859 1\n1860 1\n1861 2\n')
+        self.n_be = len(parameters.main(['-f', FF_PATH, '-pt', 'be']).params)
+        self.ff = parameters.main(['-f', FF_PATH, '-pt', 'be', '-pf', pfile])
+    def tearDown(self):
+        shutil.rmtree(self.direc)
+    def test_no_duplicates(self):
+        keys = [(x.mm3_row, x.mm3_col) for x in self.ff.params]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(len(keys), self.n_be + 1)
+        self.assertIn((1861, 2), keys)
+
+if __name__ == '__main__':
+    logging.config.dictConfig(co.LOG_SETTINGS)
+    unittest.main()